@@ -1,7 +1,15 @@
-import base64
+import re
 from io import StringIO
 from typing import cast
 
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    import base64
+
+    def b64encode_as_string(s: bytes) -> str:
+        return base64.b64encode(s).decode("ascii")
+
 from UM.Mesh.MeshWriter import MeshWriter
 from UM.Logger import Logger
 from UM.PluginRegistry import PluginRegistry
@@ -19,9 +27,16 @@ except ImportError:
     from PyQt5.QtGui import QImage
     QBufferOpenMode = QBuffer.ReadWrite
 
-from UM.i18n import i18nCatalog
 
-catalog = i18nCatalog("cura")
+BOUNDS_RE = re.compile(r"M(?:IN|AX)[XYZ]:")
+BOUNDS_NAMES = {
+    "MINX:": "min_x(mm): ",
+    "MINY:": "min_y(mm): ",
+    "MINZ:": "min_z(mm): ",
+    "MAXX:": "max_x(mm): ",
+    "MAXY:": "max_y(mm): ",
+    "MAXZ:": "max_z(mm): ",
+}
 
 
 class ModError(Exception):
@@ -31,19 +46,13 @@ class ModError(Exception):
 class SM2GCodeWriter(MeshWriter):
     PROCESSED_IDENTITY = ";Processed by Snapmaker2Plugin (https://github.com/macdylan/Snapmaker2Plugin)"
 
-    @call_on_qt_thread
+    # (signature, base64 png), shared by all instances because a new writer is created for every upload
+    _thumbnail_cache = (None, "")
+
     def write(self,
               stream,
               nodes,
               mode=MeshWriter.OutputMode.TextMode) -> bool:
-        if mode != MeshWriter.OutputMode.TextMode:
-            Logger.error("SM2GCodeWriter does not support non-text mode.")
-            self.setInformation(
-                catalog.i18nc(
-                    "@error:not supported",
-                    "SM2GCodeWriter does not support non-text mode."))
-            return False
-
         gcode = StringIO()
         writer = cast(
             MeshWriter,
@@ -57,7 +66,10 @@ class SM2GCodeWriter(MeshWriter):
         gcode.seek(0)
         try:
             result = self.mod(gcode)
-            stream.write(result.getvalue())
+            if mode == MeshWriter.OutputMode.BinaryMode:
+                # uploading, write bytes directly instead of encoding it later
+                result = result.encode()
+            stream.write(result)
             Logger.info("SM2GCodeWriter done")
             return True
         except ModError as e:
@@ -65,61 +77,80 @@ class SM2GCodeWriter(MeshWriter):
             Logger.error(e)
             return False
 
-    def mod(self, data: StringIO) -> StringIO:
-        i = 0
-        for x in data:
-            if i > 100:
-                break
-            if x.find(self.PROCESSED_IDENTITY) != -1:
-                return data
-            i += 1
-
-        data.seek(0)
-        gcodes = data.readlines()
-
-        p = StringIO()
-        p.write(self.PROCESSED_IDENTITY + "\n")
-        p.write(";Header Start\n")
-        p.write(gcodes[0])  # FLAVOR
-        p.write(gcodes[1])  # TIME
-        p.write(gcodes[2])  # Filament used
-        p.write(gcodes[3])  # Layer height
-        p.write(";header_type: 3dp\n")
-
-        ss = self._createSnapshot()
-        if ss:
-            p.write(";thumbnail: data:image/png;base64,")
-            p.write(self._encodeSnapshot(ss))
-            p.write("\n")
+    def mod(self, data: StringIO) -> str:
+        text = data.getvalue()
+        if text.find(self.PROCESSED_IDENTITY, 0, 8192) != -1:
+            return text
+
+        # first 10 lines are the header generated by cura, the last item is the rest of gcode
+        gcodes = text.split("\n", 10)
+        body = gcodes.pop()
+        gcodes = [line + "\n" for line in gcodes]
+        total_lines = text.count("\n")
+        if not text.endswith("\n"):
+            total_lines += 1
+
+        p = []
+        p.append(self.PROCESSED_IDENTITY + "\n")
+        p.append(";Header Start\n")
+        p.append(gcodes[0])  # FLAVOR
+        p.append(gcodes[1])  # TIME
+        p.append(gcodes[2])  # Filament used
+        p.append(gcodes[3])  # Layer height
+        p.append(";header_type: 3dp\n")
+
+        # the same slice result always gets the same thumbnail
+        thumbnail = self._getThumbnail(hash(text[:4096]))
+        if thumbnail:
+            p.append(";thumbnail: data:image/png;base64,")
+            p.append(thumbnail)
+            p.append("\n")
 
         app = CuraApplication.getInstance()
         print_time = int(app.getPrintInformation().currentPrintTime
                          ) * 1.07  # Times empirical parameter: 1.07
-        print_speed = float(self._getValue("speed_infill"))
-        print_temp = float(self._getValue("material_print_temperature"))
-        bed_temp = float(self._getValue("material_bed_temperature")) or 0.0
+        stack = ExtruderManager.getInstance().getActiveExtruderStack()
+        print_speed = float(self._getValueFromStack(stack, "speed_infill"))
+        print_temp = float(
+            self._getValueFromStack(stack, "material_print_temperature"))
+        bed_temp = float(
+            self._getValueFromStack(stack, "material_bed_temperature")) or 0.0
 
         if not print_speed or not print_temp:
             raise ModError(
                 "Unable to slice with the current settings: speed_infill or material_print_temperature"
             )
 
-        p.write(";file_total_lines: %d\n" % len(gcodes))
-        p.write(";estimated_time(s): %.0f\n" % print_time)
-        p.write(";nozzle_temperature(°C): %.0f\n" % print_temp)
-        p.write(";build_plate_temperature(°C): %.0f\n" % bed_temp)
-        p.write(";work_speed(mm/minute): %.0f\n" % (print_speed * 60.0))
-        p.write(gcodes[7].replace("MAXX:", "max_x(mm): "))  # max_x
-        p.write(gcodes[8].replace("MAXY:", "max_y(mm): "))  # max_y
-        p.write(gcodes[9].replace("MAXZ:", "max_z(mm): "))  # max_z
-        p.write(gcodes[4].replace("MINX:", "min_x(mm): "))  # min_x
-        p.write(gcodes[5].replace("MINY:", "min_y(mm): "))  # min_y
-        p.write(gcodes[6].replace("MINZ:", "min_z(mm): "))  # min_z
-        p.write(";Header End\n")
-
-        p.write("".join(gcodes[10:]))
-        return p
+        p.append(f";file_total_lines: {total_lines}\n")
+        p.append(f";estimated_time(s): {print_time:.0f}\n")
+        p.append(f";nozzle_temperature(°C): {print_temp:.0f}\n")
+        p.append(f";build_plate_temperature(°C): {bed_temp:.0f}\n")
+        p.append(f";work_speed(mm/minute): {print_speed * 60.0:.0f}\n")
+        # max_x, max_y, max_z, min_x, min_y, min_z
+        p.append(
+            BOUNDS_RE.sub(lambda m: BOUNDS_NAMES[m.group(0)],
+                          "".join(gcodes[7:10] + gcodes[4:7])))
+        p.append(";Header End\n")
+
+        p.append(body)
+        return "".join(p)
+
+    def _getThumbnail(self, signature: int) -> str:
+        cached_signature, cached_thumbnail = SM2GCodeWriter._thumbnail_cache
+        if cached_signature == signature:
+            Logger.debug("Using cached thumbnail image")
+            return cached_thumbnail
 
+        ss = self._createSnapshot()
+        if not ss:
+            return ""
+
+        thumbnail = self._encodeSnapshot(ss)
+        if thumbnail:
+            SM2GCodeWriter._thumbnail_cache = (signature, thumbnail)
+        return thumbnail
+
+    @call_on_qt_thread  # rendering the snapshot must be done on the Qt thread
     def _createSnapshot(self) -> QImage:
         Logger.debug("Creating thumbnail image...")
         try:
@@ -135,15 +166,13 @@ class SM2GCodeWriter(MeshWriter):
             thumbnail_buffer.open(QBufferOpenMode)
             thumbnail_image = snapshot
             thumbnail_image.save(thumbnail_buffer, "PNG")
-            base64_bytes = base64.b64encode(thumbnail_buffer.data())
-            base64_message = base64_bytes.decode('ascii')
+            base64_message = b64encode_as_string(thumbnail_buffer.data().data())
             thumbnail_buffer.close()
             return base64_message
         except Exception:
             Logger.logException("w", "Failed to encode snapshot image")
 
-    def _getValue(self, key) -> str:
-        stack = ExtruderManager.getInstance().getActiveExtruderStack()
+    def _getValueFromStack(self, stack, key) -> str:
         if not stack:
             return ""
 
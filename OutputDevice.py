@@ -1,7 +1,7 @@
 import time
-import json
-from typing import List
-from io import StringIO
+from collections import deque
+from typing import List, Deque, Tuple
+from urllib.parse import urlencode
 
 from cura.CuraApplication import CuraApplication
 from cura.PrinterOutput.NetworkedPrinterOutputDevice import NetworkedPrinterOutputDevice, AuthState
@@ -12,10 +12,19 @@ from UM.Message import Message
 from UM.FileHandler.WriteFileJob import WriteFileJob
 
 from .qt_comp import *
+from .json_comp import json_loads
 from .GCodeWriter import SM2GCodeWriter
 
+HEARTBEAT_INTERVAL = 3000  # 3 seconds
+HEARTBEAT_INTERVAL_UPLOADING = 10000  # 10 seconds
+HEARTBEAT_INTERVAL_NEED_AUTH = 1500  # 1.5 seconds
+REQUEST_TIMEOUT = 5000  # abort if no data transferred within 5 seconds, except /upload
+UPLOAD_QUEUE_SIZE = 4
+RETRY_UPLOAD_TIMEOUT = 5 * 60 * 1000  # keep failed upload for 5 minutes
+
 
 class SM2OutputDevice(NetworkedPrinterOutputDevice):
+    tokenChanged = pyqtSignal(str, str)  # device id, token
 
     def __init__(self, device_id, address, token, properties={}, **kwargs):
         assert "@" in device_id
@@ -23,10 +32,40 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
 
         self._name, self._model = device_id.rsplit("@", 1)
         self._token = token
+        self._token_part = self._createFormPart("name=token", token.encode())
 
         self._filename = ""
         self._api_prefix = ":8080/api/v1"
-        self._gcode_stream = StringIO()
+        self._gcode_file = None  # type: QTemporaryFile
+        self._upload_reply = None  # type: QNetworkReply  # pending /upload
+        self._sending_gcode = False
+        # written gcode files waiting for upload, (file, filename)
+        self._upload_queue = deque()  # type: Deque[Tuple[QTemporaryFile, str]]
+        self._writing_jobs = 0
+
+        # failed upload (file, filename) kept for retry without slicing again
+        self._retry_upload = None  # type: Tuple[QTemporaryFile, str]
+        self._retry_message = None  # type: Message  # offers the retry
+        self._retry_timer = QTimer()
+        self._retry_timer.setInterval(RETRY_UPLOAD_TIMEOUT)
+        self._retry_timer.setSingleShot(True)
+        self._retry_timer.timeout.connect(self._discardRetryUpload)
+
+        # poll status after the previous status reply, never overlap requests
+        self._heartbeat_interval = HEARTBEAT_INTERVAL
+        self._status_timer = QTimer()
+        self._status_timer.setSingleShot(True)
+        self._status_timer.timeout.connect(self.checkStatus)
+
+        # (http method, last part of the url path) -> reply handler
+        self._reply_handlers = {
+            (QNetworkAccessManagerOperations.GetOperation, "status"):
+            self._onStatusReply,
+            (QNetworkAccessManagerOperations.PostOperation, "connect"):
+            self._onConnectReply,
+            (QNetworkAccessManagerOperations.PostOperation, "upload"):
+            self._onUploadReply,
+        }
 
         self.setPriority(2)
         self.setShortDescription("Send to {}".format(self._address))  # button
@@ -45,7 +84,11 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
         return self._token
 
     def setToken(self, token: str):
-        self._token = token
+        if self._token != token:
+            self._token = token
+            self._token_part = self._createFormPart("name=token",
+                                                    token.encode())
+            self.tokenChanged.emit(self.getId(), token)
 
     def getModel(self) -> str:
         return self._model
@@ -68,7 +111,8 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
 
         if (self.connectionState == ConnectionState.Connected
                 and self.authenticationState == AuthState.Authenticated):
-            if self._sending_gcode and not self._progress.visible:
+            if (self._sending_gcode and self._gcode_file
+                    and not self._progress.visible):
                 self._progress.show()
                 self._upload()
 
@@ -78,9 +122,9 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
         elif self.authenticationState == AuthState.AuthenticationRequested:
             self._need_auth.show()
         elif self.authenticationState == AuthState.AuthenticationDenied:
-            self._token = ""
-            self._sending_gcode = False
-            self._need_auth.hide()
+            self.setToken("")
+            self._abortUpload()
+            self._clearUploadQueue()
 
     def requestWrite(self,
                      nodes,
@@ -94,20 +138,26 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
                     text="{} is busy.".format(self.getId())).show()
             return
 
-        if self._progress.visible or self._need_auth.visible:
-            Logger.info("Still working in progress.")
+        if len(self._upload_queue) + self._writing_jobs >= UPLOAD_QUEUE_SIZE:
+            Message(title="Unable to upload",
+                    text="Too many files waiting to be sent to {}.".format(
+                        self.getId())).show()
             return
 
-        # reset
-        self._sending_gcode = True
-        self.setConnectionState(ConnectionState.Closed)
-        self.setAuthenticationState(AuthState.NotAuthenticated)
+        # gcode is written into a temporary file that is used as upload body later
+        gcode_file = QTemporaryFile()
+        if not gcode_file.open():
+            Message(title="Unable to upload",
+                    text="Failed to create temporary file: {}".format(
+                        gcode_file.errorString())).show()
+            return
 
         self.writeStarted.emit(self)
-        self._gcode_stream = StringIO()
-        job = WriteFileJob(SM2GCodeWriter(), self._gcode_stream, nodes,
-                           SM2GCodeWriter.OutputMode.TextMode)
+        job = WriteFileJob(SM2GCodeWriter(), gcode_file, nodes,
+                           SM2GCodeWriter.OutputMode.BinaryMode)
+        job.setFileName(self._jobFileName())
         job.finished.connect(self._onWriteJobFinished)
+        self._writing_jobs += 1
 
         message = Message(title="Preparing for upload",
                           progress=-1,
@@ -119,13 +169,131 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
         job.setMessage(message)
         job.start()
 
+        # nothing else to send, connect while the gcode is being written
+        if (not self._sending_gcode and not self._upload_queue
+                and self._writing_jobs == 1):
+            self._openSession()
+
     def _onWriteJobFinished(self, job):
+        self._writing_jobs -= 1
+        # session opened early in requestWrite is waiting for this file
+        waiting = self._sending_gcode and not self._gcode_file
+
+        if not job.getResult():
+            job.getStream().close()
+            if waiting:
+                self._abortUpload()
+                self._byebye()
+            return
+
+        if waiting:
+            self._gcode_file = job.getStream()
+            self._filename = job.getFileName()
+            self._onConnectionStateChanged(self.getId())
+            return
+
+        self._upload_queue.append((job.getStream(), job.getFileName()))
+        self._startNextUpload()
+
+    def _jobFileName(self) -> str:
+        print_info = CuraApplication.getInstance().getPrintInformation()
+        job_name = (print_info.jobName or "").strip() or "untitled"
+        print_time = print_info.currentPrintTime
+        material_name = "-".join(print_info.materialNames)
+
+        hours = print_time.days * 24 + print_time.hours
+        return (f"{job_name}_{material_name}_"
+                f"{hours}h{print_time.minutes}m{print_time.seconds}s.gcode")
+
+    def _startNextUpload(self) -> None:
+        if self._sending_gcode or not self._upload_queue:
+            return
+
+        self._gcode_file, self._filename = self._upload_queue.popleft()
+        self._openSession()
+
+    def _openSession(self) -> None:
+        # reset
+        self._sending_gcode = True
+        self.setConnectionState(ConnectionState.Closed)
+        self.setAuthenticationState(AuthState.NotAuthenticated)
+
         self._hello()
 
+    def _abortUpload(self) -> None:
+        self._sending_gcode = False
+        self._status_timer.stop()
+        self._heartbeat_interval = HEARTBEAT_INTERVAL
+        self._progress.hide()
+        self._need_auth.hide()
+        if self._upload_reply:
+            # stop sending before the body file is closed
+            reply, self._upload_reply = self._upload_reply, None
+            reply.abort()
+        if self._gcode_file:
+            self._gcode_file.close()
+            self._gcode_file = None
+
+    def _abortSession(self) -> None:
+        Message(title="Unable to upload",
+                text="Sending to {} was cancelled.".format(self.getId()),
+                lifetime=10).show()
+        self._abortUpload()
+        self._byebye()  # next upload starts after disconnected
+
+    def _keepForRetry(self, message: Message) -> None:
+        self._discardRetryUpload()
+        self._retry_upload = (self._gcode_file, self._filename)
+        self._gcode_file = None
+        self._abortUpload()
+
+        self._retry_message = message
+        message.addAction("retry", "Retry", "", "")
+        message.actionTriggered.connect(self._onRetryTriggered)
+        self._retry_timer.start()
+
+    def _discardRetryUpload(self) -> None:
+        self._retry_timer.stop()
+        if self._retry_message:
+            # its Retry action would send another file
+            self._retry_message.hide()
+            self._retry_message = None
+        if self._retry_upload:
+            self._retry_upload[0].close()
+            self._retry_upload = None
+
+    def _onRetryTriggered(self, message: Message, action: str) -> None:
+        message.hide()
+        if message is not self._retry_message or not self._retry_upload:
+            Message(title="Unable to upload",
+                    text="The file is no longer available, please send again."
+                    ).show()
+            return
+
+        self._retry_timer.stop()
+        self._upload_queue.appendleft(self._retry_upload)
+        self._retry_upload = None
+        self._retry_message = None
+        self._startNextUpload()
+
+    def _clearUploadQueue(self) -> None:
+        for gcode_file, _ in self._upload_queue:
+            gcode_file.close()
+        self._upload_queue.clear()
+
+    def _createEmptyRequest(self, target: str, *args,
+                            **kwargs) -> QNetworkRequest:
+        request = super()._createEmptyRequest(target, *args, **kwargs)
+        # the printer may be silent for a while storing the uploaded file
+        if (not target.startswith("/upload")
+                and hasattr(request, "setTransferTimeout")):  # Qt 5.15+
+            request.setTransferTimeout(REQUEST_TIMEOUT)
+        return request
+
     def _queryParams(self) -> List[QHttpPart]:
         return [
-            self._createFormPart('name=token', self._token.encode()),
-            self._createFormPart('name=_', "{}".format(time.time()).encode())
+            self._token_part,
+            self._createFormPart('name=_', str(time.time()).encode())
         ]
 
     def _hello(self) -> None:
@@ -135,11 +303,17 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
     def _byebye(self):
         if self._token:
             self.postFormWithParts(
-                "/disconnect", self._queryParams(),
-                lambda r: self.setConnectionState(ConnectionState.Closed))
+                "/disconnect", self._queryParams(), self._onDisconnected)
+        else:
+            self._startNextUpload()
+
+    def _onDisconnected(self, reply: QNetworkReply) -> None:
+        self.setConnectionState(ConnectionState.Closed)
+        # start next upload after the session is closed
+        self._startNextUpload()
 
     def checkStatus(self):
-        url = "/status?token={}&_={}".format(self._token, time.time())
+        url = "/status?" + urlencode({"token": self._token, "_": time.time()})
         self.get(url, self._onRequestFinished)
 
     def _upload(self):
@@ -147,47 +321,72 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
         if not self._token:
             return
 
-        print_info = CuraApplication.getInstance().getPrintInformation()
-        job_name = print_info.jobName.strip()
-        print_time = print_info.currentPrintTime
-        material_name = "-".join(print_info.materialNames)
-
-        self._filename = "{}_{}_{}.gcode".format(
-            job_name, material_name,
-            "{}h{}m{}s".format(print_time.days * 24 + print_time.hours,
-                               print_time.minutes, print_time.seconds))
+        # let Qt read the body from the file while sending, the file must stay alive until upload finished
+        self._gcode_file.seek(0)
 
         parts = self._queryParams()
         parts.append(
-            self._createFormPart(
+            self._createFormDevicePart(
                 'name=file; filename="{}"'.format(self._filename),
-                self._gcode_stream.getvalue().encode()))
-        self._gcode_stream.close()
-        self.postFormWithParts("/upload",
-                               parts,
-                               on_finished=self._onRequestFinished,
-                               on_progress=self._onUploadProgress)
+                self._gcode_file))
+        self._upload_reply = self.postFormWithParts(
+            "/upload",
+            parts,
+            on_finished=self._onRequestFinished,
+            on_progress=self._onUploadProgress)
+
+    def _createFormDevicePart(self, content_header: str,
+                              device: QIODevice) -> QHttpPart:
+        part = QHttpPart()
+        part.setHeader(QNetworkRequestKnownHeaders.ContentDispositionHeader,
+                       "form-data; " + content_header)
+        part.setBodyDevice(device)
+        return part
 
     def _onUploadProgress(self, bytes_sent: int, bytes_total: int):
         if bytes_total > 0:
             perc = (bytes_sent / bytes_total) if bytes_total else 0
             self._progress.setProgress(perc * 100)
+            if perc > 0.05:
+                # status rarely changes while uploading
+                self._heartbeat_interval = HEARTBEAT_INTERVAL_UPLOADING
             self.writeProgress.emit()
 
     def _onRequestFinished(self, reply: QNetworkReply) -> None:
         http_url = reply.url().toString()
 
+        if reply.url().path().endswith("/upload"):
+            if reply is not self._upload_reply:
+                # the upload has been aborted while sending
+                return
+            self._upload_reply = None
+
         if reply.error() not in (
                 QNetworkReplyNetworkErrors.NoError,
                 QNetworkReplyNetworkErrors.
                 AuthenticationRequiredError  # 204 is No Content, not an error
         ):
             Logger.warning("Error %d from %s", reply.error(), http_url)
+            if (self._sending_gcode
+                    and reply.url().path().endswith("/status")):
+                # a lost status poll doesn't break the session in progress
+                self._scheduleStatusCheck()
+                return
+
             self.setConnectionState(ConnectionState.Closed)
-            Message(title="Error",
-                    text=reply.errorString(),
-                    lifetime=0,
-                    dismissable=True).show()
+            message = Message(title="Error",
+                              text=reply.errorString(),
+                              lifetime=0,
+                              dismissable=True)
+            if (self._sending_gcode and reply.url().path().endswith(
+                ("/connect", "/upload"))):
+                if self._gcode_file:
+                    self._keepForRetry(message)
+                else:
+                    # still writing, the file is queued when it's done
+                    self._abortUpload()
+                self._startNextUpload()
+            message.show()
             return
 
         http_code = reply.attribute(
@@ -196,62 +395,92 @@ class SM2OutputDevice(NetworkedPrinterOutputDevice):
         if not http_code:
             return
 
-        http_method = reply.operation()
-        if http_method == QNetworkAccessManagerOperations.GetOperation:
-            if self._api_prefix + "/status" in http_url:
-                if http_code == 200:
-                    self.setAuthenticationState(AuthState.Authenticated)
-                    resp = self._jsonReply(reply)
-                    device_status = resp.get("status", "UNKNOWN")
-                    self.setDeviceStatus(device_status)
-                elif http_code == 401:
-                    self.setAuthenticationState(AuthState.AuthenticationDenied)
-                elif http_code == 204:
-                    self.setAuthenticationState(
-                        AuthState.AuthenticationRequested)
-                else:
-                    self.setAuthenticationState(AuthState.NotAuthenticated)
-
-        elif http_method == QNetworkAccessManagerOperations.PostOperation:
-            if self._api_prefix + "/connect" in http_url:
-                if http_code == 200:
-                    resp = self._jsonReply(reply)
-                    token = resp.get("token")
-                    if self._token != token:
-                        self._token = token
-                    self.checkStatus()  # check status and upload
-
-                elif http_code == 403 and self._token:
-                    # expired
-                    self._token = ""
-                    self.connect()
-                else:
-                    self.setConnectionState(ConnectionState.Closed)
-                    Message(
-                        title="Error",
-                        text=
-                        "Please check the touchscreen and try again (Err: {})."
-                        .format(http_code),
-                        lifetime=10,
-                        dismissable=True).show()
-
-            # elif self._api_prefix + "/disconnect" in http_url:
-            #     self.setConnectionState(ConnectionState.Closed)
-
-            elif self._api_prefix + "/upload" in http_url:
-                self._progress.hide()
-                self.writeFinished.emit()
-                self._sending_gcode = False
-
-                Message(title="Sent to {}".format(self.getId()),
-                        text="Start print on the touchscreen: {}".format(
-                            self._filename),
-                        lifetime=60).show()
+        endpoint = reply.url().path().rsplit("/", 1)[-1]
+        handler = self._reply_handlers.get((reply.operation(), endpoint))
+        if handler:
+            handler(reply, http_code)
+
+    def _onStatusReply(self, reply: QNetworkReply, http_code: int) -> None:
+        if not self._sending_gcode:
+            # the session has been closed
+            return
+
+        if http_code == 200:
+            self.setAuthenticationState(AuthState.Authenticated)
+            resp = self._jsonReply(reply)
+            device_status = resp.get("status", "UNKNOWN")
+            self.setDeviceStatus(device_status)
+        elif http_code == 401:
+            self.setAuthenticationState(AuthState.AuthenticationDenied)
+        elif http_code == 204:
+            self.setAuthenticationState(AuthState.AuthenticationRequested)
+        else:
+            self.setAuthenticationState(AuthState.NotAuthenticated)
+
+        self._scheduleStatusCheck()
+
+    def _onConnectReply(self, reply: QNetworkReply, http_code: int) -> None:
+        if not self._sending_gcode:
+            # the session has been closed
+            return
+
+        # every branch either posts the next request or ends the session,
+        # otherwise the upload queue never moves on
+        if http_code == 200:
+            resp = self._jsonReply(reply)
+            self.setToken(resp.get("token") or "")
+            self.checkStatus()  # check status and upload
+
+        elif http_code == 403 and self._token:
+            # expired, connect again without token
+            self.setToken("")
+            self._hello()
+        else:
+            self.setConnectionState(ConnectionState.Closed)
+            Message(title="Error",
+                    text="Please check the touchscreen and try again (Err: {})."
+                    .format(http_code),
+                    lifetime=10,
+                    dismissable=True).show()
+            self._abortUpload()
+            self._startNextUpload()
+
+    def _onUploadReply(self, reply: QNetworkReply, http_code: int) -> None:
+        if self._gcode_file:
+            self._gcode_file.close()  # removed automatically
+            self._gcode_file = None
+        self._progress.hide()
+        self._status_timer.stop()  # the session is closed next
+        self._heartbeat_interval = HEARTBEAT_INTERVAL
+
+        Message(title="Sent to {}".format(self.getId()),
+                text="Start print on the touchscreen: {}".format(
+                    self._filename),
+                lifetime=60).show()
+
+        self._sending_gcode = False
+        self.writeFinished.emit()  # next upload starts after disconnected
+
+    def _scheduleStatusCheck(self):
+        if self._need_auth.visible:
+            self._status_timer.setInterval(HEARTBEAT_INTERVAL_NEED_AUTH)
+        elif self._progress.visible or (self._sending_gcode
+                                        and not self._gcode_file):
+            # uploading, or connected early and waiting for the gcode
+            self._status_timer.setInterval(self._heartbeat_interval)
+        else:
+            if self._sending_gcode and self._gcode_file:
+                # not uploading and nobody waits for authorization, e.g. the
+                # message was dismissed or the printer is busy
+                self._abortSession()
+            return
+
+        self._status_timer.start()
 
     def _jsonReply(self, reply: QNetworkReply):
         try:
-            return json.loads(bytes(reply.readAll()).decode("utf-8"))
-        except json.decoder.JSONDecodeError:
+            return json_loads(bytes(reply.readAll()))
+        except ValueError:
             Logger.warning("Received invalid JSON from snapmaker.")
             return {}
 
@@ -264,12 +493,6 @@ class PrintJobUploadProgressMessage(Message):
                          lifetime=0,
                          dismissable=False,
                          use_inactivity_timer=False)
-        self._device = device
-        self._gTimer = QTimer()
-        self._gTimer.setInterval(3 * 1000)
-        self._gTimer.timeout.connect(lambda: self._heartbeat())
-        self.inactivityTimerStart.connect(self._startTimer)
-        self.inactivityTimerStop.connect(self._stopTimer)
 
     def show(self):
         self.setProgress(0)
@@ -280,17 +503,6 @@ class PrintJobUploadProgressMessage(Message):
             super().show()
         self.setProgress(percentage)
 
-    def _heartbeat(self):
-        self._device.checkStatus()
-
-    def _startTimer(self):
-        if self._gTimer and not self._gTimer.isActive():
-            self._gTimer.start()
-
-    def _stopTimer(self):
-        if self._gTimer and self._gTimer.isActive():
-            self._gTimer.stop()
-
 
 class PrintJobNeedAuthMessage(Message):
 
@@ -301,21 +513,4 @@ class PrintJobNeedAuthMessage(Message):
             lifetime=0,
             dismissable=True,
             use_inactivity_timer=False)
-        self._device = device
         self.setProgress(-1)
-        self._gTimer = QTimer()
-        self._gTimer.setInterval(1500)
-        self._gTimer.timeout.connect(lambda: self._onCheck(None, None))
-        self.inactivityTimerStart.connect(self._startTimer)
-        self.inactivityTimerStop.connect(self._stopTimer)
-
-    def _startTimer(self):
-        if self._gTimer and not self._gTimer.isActive():
-            self._gTimer.start()
-
-    def _stopTimer(self):
-        if self._gTimer and self._gTimer.isActive():
-            self._gTimer.stop()
-
-    def _onCheck(self, *args, **kwargs):
-        self._device.checkStatus()
@@ -1,6 +1,6 @@
-import json
+import re
 import socket
-from typing import List, Dict
+from typing import List, Dict, Set
 
 from UM.Logger import Logger
 from UM.Platform import Platform
@@ -9,11 +9,21 @@ from UM.OutputDevice.OutputDevicePlugin import OutputDevicePlugin
 from UM.Application import Application
 
 from .qt_comp import *
+from .json_comp import json_loads, json_dumps
 from .OutputDevice import SM2OutputDevice
 
 #MACHINE_SERIES = "Snapmaker A"
 DISCOVER_PORT = 20054
 DISCOVER_INTERVAL = 6000  # 6 seconds
+DISCOVER_INTERVAL_MAX = 30000  # 30 seconds, when discovered printers keep unchanged
+DISCOVER_DATAGRAM_SIZE = 1500  # ethernet MTU
+DISCOVER_RECV_BUFFER_SIZE = 4 * 1024 * 1024  # many printers may reply at the same time
+DISCOVER_MAX_DATAGRAMS = 64  # datagrams handled per read, avoid starving the event loop
+SAVE_TOKENS_DELAY = 30000  # 30 seconds
+
+# Snapmaker-DUMMY@127.0.0.1|model:Snapmaker 2 Model A350|status:IDLE
+DISCOVER_MESSAGE_RE = re.compile(
+    r"^(?P<name>[^|]+)@(?P<address>[^@|]+)\|model:(?P<model>[^|]*)")
 
 
 @signalemitter
@@ -25,36 +35,53 @@ class DiscoverSocket:
         self._broadcast_address = address_entry.broadcast()
 
         self._socket = None  # internal socket
-
-        self._collect_timer = QTimer()
-        self._collect_timer.setInterval(200)
-        self._collect_timer.setSingleShot(True)
-        self._collect_timer.timeout.connect(self.__collect)
+        # notify when the original socket is readable
+        self._notifier = None  # type: QSocketNotifier
 
     @property
     def address(self) -> QHostAddress:
         return self._address_entry.ip()
 
     def bind(self) -> bool:
-        sock = QUdpSocket()
-
-        bind_result = sock.bind(self._address_entry.ip(),
-                                mode=QAbstractSocket.BindFlag.DontShareAddress
-                                | QAbstractSocket.BindFlag.ReuseAddressHint)
-        if not bind_result:
-            return False
-
         if Platform.isWindows():
             # On Windows, QUdpSocket is unable to receive broadcast data, we use original socket instead
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                  socket.IPPROTO_UDP)
-            sock.settimeout(0.2)
+            sock.setblocking(False)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            DISCOVER_RECV_BUFFER_SIZE)
+            Logger.debug("receive buffer size: %d",
+                         sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+            # bind to an ephemeral port on this interface, broadcast is sent from it
+            try:
+                sock.bind((self._address_entry.ip().toString(), 0))
+            except OSError as e:
+                Logger.error("error binding socket: %s", e)
+                sock.close()
+                return False
+
             self._socket = sock
+            self._notifier = QSocketNotifier(sock.fileno(),
+                                             QSocketNotifierType.Read)
+            self._notifier.activated.connect(self.__collect)
         else:
             # On Unix, we use socket interface provided by Qt 6
+            sock = QUdpSocket()
+            bind_result = sock.bind(
+                self._address_entry.ip(),
+                mode=QAbstractSocket.BindFlag.DontShareAddress
+                | QAbstractSocket.BindFlag.ReuseAddressHint)
+            if not bind_result:
+                return False
+
+            sock.setSocketOption(QSocketOptions.ReceiveBufferSizeSocketOption,
+                                 DISCOVER_RECV_BUFFER_SIZE)
+            Logger.debug(
+                "receive buffer size: %s",
+                sock.socketOption(
+                    QSocketOptions.ReceiveBufferSizeSocketOption))
             self._socket = sock
             sock.readyRead.connect(self.__read)
 
@@ -67,7 +94,6 @@ class DiscoverSocket:
         else:
             self._socket.sendto(
                 message, (self._broadcast_address.toString(), DISCOVER_PORT))
-            self._collect_timer.start()
 
     def abort(self) -> None:
         if not self._socket:
@@ -76,22 +102,30 @@ class DiscoverSocket:
         if isinstance(self._socket, QUdpSocket):
             self._socket.abort()
         else:
+            self._notifier.setEnabled(False)
+            self._notifier = None
             self._socket.close()
 
         self._socket = None
 
     def __read(self) -> None:
-        while self._socket.hasPendingDatagrams():
-            data = self._socket.receiveDatagram()
-            if data.isValid() and not data.senderAddress().isNull():
-                try:
-                    message = bytes(data.data()).decode("utf-8")
-                    self.dataReady.emit(message)
-                except UnicodeDecodeError as e:
-                    Logger.error("error decoding data: %s", e)
-                    pass
-
-    def __collect(self) -> None:
+        if not self._socket:
+            return
+
+        for _ in range(DISCOVER_MAX_DATAGRAMS):
+            if not self._socket.hasPendingDatagrams():
+                return
+
+            data, host, _port = self._socket.readDatagram(
+                self._socket.pendingDatagramSize())
+            if data and not host.isNull():
+                self.dataReady.emit(data)
+
+        # continue with the rest in next event loop iteration
+        if self._socket.hasPendingDatagrams():
+            QTimer.singleShot(0, self.__read)
+
+    def __collect(self, *args) -> None:
         # the socket has abort and discover is cancelled
         if not self._socket:
             return
@@ -101,19 +135,18 @@ class DiscoverSocket:
 
         while True:
             try:
-                msg, _ = self._socket.recvfrom(128)
-            except (TimeoutError, ConnectionError, socket.timeout) as e:
+                data, _ = self._socket.recvfrom(DISCOVER_DATAGRAM_SIZE)
+            except BlockingIOError:
+                # all received datagrams have been read
+                break
+            except ConnectionError as e:
                 Logger.error("error receiving data: %s", e)
-                # normal timeout, or ConnectionError (including ConnectionAbortedError, ConnectionRefusedError,
+                # ConnectionError (including ConnectionAbortedError, ConnectionRefusedError,
                 # ConnectionResetError) errors raise by the peer
                 break
 
-            try:
-                message = msg.decode("utf-8")
-                self.dataReady.emit(message)
-            except UnicodeDecodeError as e:
-                Logger.error("error decoding data: %s", e)
-                pass
+            if data:
+                self.dataReady.emit(data)
 
 
 class SM2OutputDevicePlugin(OutputDevicePlugin):
@@ -128,7 +161,19 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
         self._discover_timer.timeout.connect(self.__discover)
 
         self._discover_sockets = []  # type: List[QUdpSocket]
+        # message -> device id ("" for ignored message), messages not received in last round are forgotten
+        self._discovered = {}  # type: Dict[bytes, str]
+        self._received = set()  # type: Set[bytes]
+        self._discovery_changed = False
+        self._stable_rounds = 0
         self._tokens = {}  # type: Dict[str, str]
+        self._tokens_dirty = False
+
+        # coalesce token changes into one preferences write
+        self._save_tokens_timer = QTimer()
+        self._save_tokens_timer.setInterval(SAVE_TOKENS_DELAY)
+        self._save_tokens_timer.setSingleShot(True)
+        self._save_tokens_timer.timeout.connect(self._saveTokens)
 
         Application.getInstance().globalContainerStackChanged.connect(
             self._onGlobalContainerStackChanged)
@@ -139,7 +184,7 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
         preferences.addPreference(self.PREFERENCE_KEY_TOKEN, "{}")
 
         try:
-            self._tokens = json.loads(
+            self._tokens = json_loads(
                 preferences.getValue(self.PREFERENCE_KEY_TOKEN))
         except ValueError:
             pass
@@ -147,26 +192,28 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
         if not isinstance(self._tokens, dict):
             self._tokens = {}
 
-        Logger.debug("(%d) tokens loaded.", len(self._tokens.keys()))
+        Logger.debug("(%d) tokens loaded.", len(self._tokens))
 
-    def _saveTokens(self) -> None:
-        updated = False
-        devices = self.getOutputDeviceManager().getOutputDevices()
+    def _onTokenChanged(self, device_id: str, token: str) -> None:
+        # keep the last valid token, the device may clear it when expired or denied
+        if token and self._tokens.get(device_id, "") != token:
+            self._tokens[device_id] = token
+            self._tokens_dirty = True
+            if not self._save_tokens_timer.isActive():
+                self._save_tokens_timer.start()
 
-        for d in devices:
-            if isinstance(d, SM2OutputDevice) and d.getToken():
-                ex_token = self._tokens.get(d.getId(), "")
-                if not ex_token or ex_token != d.getToken():
-                    self._tokens[d.getId()] = d.getToken()
-                    updated = True
+    def _saveTokens(self) -> None:
+        if not self._tokens_dirty:
+            return
 
-        if updated:
-            try:
-                Application.getInstance().getPreferences().setValue(
-                    self.PREFERENCE_KEY_TOKEN, json.dumps(self._tokens))
-                Logger.debug("(%d) tokens saved.", len(self._tokens.keys()))
-            except ValueError:
-                self._tokens = {}
+        self._tokens_dirty = False
+        try:
+            Application.getInstance().getPreferences().setValue(
+                self.PREFERENCE_KEY_TOKEN,
+                json_dumps(self._tokens))
+            Logger.debug("(%d) tokens saved.", len(self._tokens))
+        except ValueError:
+            self._tokens = {}
 
     def _deviceId(self, name, model) -> str:
         return "{}@{}".format(name, model)
@@ -174,6 +221,14 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
     def __prepare(self) -> None:
         self._discover_sockets = []
         for interface in QNetworkInterface.allInterfaces():
+            flags = interface.flags()
+            # skip interfaces that are down or unable to send broadcast
+            if (not flags & QNetworkInterfaceFlags.IsUp
+                    or not flags & QNetworkInterfaceFlags.IsRunning
+                    or not flags & QNetworkInterfaceFlags.CanBroadcast
+                    or flags & QNetworkInterfaceFlags.IsLoopBack):
+                continue
+
             for address_entry in interface.addressEntries():
                 address = address_entry.ip()
                 if address.isLoopback():
@@ -193,54 +248,77 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
         if not self._discover_sockets:
             self.__prepare()
 
+        for data in self._discovered.keys() - self._received:
+            del self._discovered[data]
+            self._discovery_changed = True
+        self._received.clear()
+
+        # slow down while replies keep unchanged, stay fast when nothing is found
+        if self._discovery_changed or not self._discovered:
+            self._stable_rounds = 0
+        else:
+            self._stable_rounds = min(self._stable_rounds + 1, 3)
+        self._discovery_changed = False
+        self._discover_timer.setInterval(
+            min(DISCOVER_INTERVAL * 2**self._stable_rounds,
+                DISCOVER_INTERVAL_MAX))
+
+        Logger.debug("Discovering networked printer... (%d interfaces)",
+                     len(self._discover_sockets))
         for sock in self._discover_sockets:
-            Logger.debug("Discovering networked printer... (interface: %s)",
-                         sock.address.toString())
             sock.discover(b"discover")
 
-        self._saveTokens()  # TODO
-
         # TODO: remove output devices that not reply message for a period of time
 
-    def __onData(self, msg: str) -> None:
+    def __onData(self, data: bytes) -> None:
         """Parse message.
 
-        msg: Snapmaker-DUMMY@127.0.0.1|model:Snapmaker 2 Model A350|status:IDLE
+        data: b"Snapmaker-DUMMY@127.0.0.1|model:Snapmaker 2 Model A350|status:IDLE"
         """
-        Logger.debug("got msg: %s", msg)
-        parts = msg.split("|")
-        if len(parts) < 1 or "@" not in parts[0]:
-            # invalid message
+        self._received.add(data)
+        if data in self._discovered:
+            # nothing changed since last time, skip decoding
             return
 
-        name, address = parts[0].rsplit("@", 1)
+        self._discovered[data] = ""
+        self._discovery_changed = True
+        try:
+            msg = data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            Logger.error("error decoding data: %s", e)
+            return
 
-        properties = {}
-        for part in parts[1:]:
-            if ":" not in part:
-                continue
+        Logger.debug("got msg: %s", msg)
 
-            key, value = part.split(":")
-            properties[key] = value
+        m = DISCOVER_MESSAGE_RE.match(msg)
+        if not m:
+            # invalid message
+            return
 
-        model = properties.get("model", "")
-        Logger.debug("machine model is %s", model)
+        name, address, model = m.group("name", "address", "model")
         if not model.startswith("Snapmaker 2"):
             return
 
         device_id = self._deviceId(name, model)
+        self._discovered[data] = device_id
 
         device = self.getOutputDeviceManager().getOutputDevice(device_id)
         if not device:
+            properties = dict(
+                part.split(":", 1) for part in msg.split("|")[1:]
+                if ":" in part)
             token = self._tokens.get(device_id, "")
             Logger.info("Discovered Snapmaker printer: %s@%s (token: '%s')",
                         name, address, token)
             device = SM2OutputDevice(device_id, address, token, properties)
+            device.tokenChanged.connect(self._onTokenChanged)
             self.getOutputDeviceManager().addOutputDevice(device)
 
     def start(self) -> None:
         if self._isSM2Container() and not self._discover_timer.isActive():
             self._loadTokens()
+            self._stable_rounds = 0
+            self._discover_timer.setInterval(DISCOVER_INTERVAL)
             self._discover_timer.start()
             Logger.info("Snapmaker discovering started.")
 
@@ -253,7 +331,10 @@ class SM2OutputDevicePlugin(OutputDevicePlugin):
 
         # clear all discover sockets
         self._discover_sockets.clear()
+        self._discovered.clear()
+        self._received.clear()
 
+        self._save_tokens_timer.stop()
         self._saveTokens()
 
         Logger.info("Snapmaker discovering stopped.")
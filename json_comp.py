@@ -0,0 +1,16 @@
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    import json
+
+    def json_loads(s):
+        return json.loads(s)
+
+    def json_dumps(obj) -> str:
+        return json.dumps(obj, separators=(",", ":"))
@@ -1,6 +1,6 @@
 
 try:
-    from PyQt6.QtCore import QTimer, pyqtProperty, pyqtSignal
+    from PyQt6.QtCore import QTimer, QIODevice, QTemporaryFile, QSocketNotifier, pyqtProperty, pyqtSignal
     from PyQt6.QtNetwork import (
         QHttpPart,
         QUdpSocket,
@@ -13,11 +13,15 @@ try:
         QNetworkReply
     )
     QIPv4Protocol = QAbstractSocket.NetworkLayerProtocol.IPv4Protocol
+    QSocketOptions = QAbstractSocket.SocketOption
+    QNetworkInterfaceFlags = QNetworkInterface.InterfaceFlag
+    QSocketNotifierType = QSocketNotifier.Type
     QNetworkAccessManagerOperations = QNetworkAccessManager.Operation
     QNetworkRequestAttributes = QNetworkRequest.Attribute
+    QNetworkRequestKnownHeaders = QNetworkRequest.KnownHeaders
     QNetworkReplyNetworkErrors = QNetworkReply.NetworkError
 except ImportError:
-    from PyQt5.QtCore import QTimer, pyqtProperty, pyqtSignal
+    from PyQt5.QtCore import QTimer, QIODevice, QTemporaryFile, QSocketNotifier, pyqtProperty, pyqtSignal
     from PyQt5.QtNetwork import (
         QHttpPart,
         QNetworkRequest,
@@ -30,7 +34,11 @@ except ImportError:
         QHostAddress
     )
     QNetworkAccessManagerOperations = QNetworkAccessManager
+    QSocketOptions = QAbstractSocket
+    QNetworkInterfaceFlags = QNetworkInterface
+    QSocketNotifierType = QSocketNotifier
     QNetworkRequestAttributes = QNetworkRequest
+    QNetworkRequestKnownHeaders = QNetworkRequest
     QNetworkReplyNetworkErrors = QNetworkReply
     if hasattr(QAbstractSocket, 'IPv4Protocol'):
         QIPv4Protocol = QAbstractSocket.IPv4Protocol